@@ -1,13 +1,25 @@
+import math
 import os
+import shelve
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from dataclasses import dataclass, asdict
 from enum import Enum
-from typing import Any, Optional, Generator, Callable
+from itertools import islice
+from typing import Any, Optional, Generator, Callable, Iterable
 
+import orjson
+import requests
+import requests.adapters
 import spotipy
 from spotipy import SpotifyOAuth
 from tqdm import tqdm
 
-from PlaylistSplitter.playlist_splitter_defs import AUTHORIZATION_SCOPES, SplitTypes
+from PlaylistSplitter.playlist_splitter_defs import AUTHORIZATION_SCOPES, SplitTypes, LOOKUP_WORKERS, \
+    RATE_LIMIT_RETRIES, ALBUM_BATCH_SIZE, CACHE_DIR, PAGE_SIZE, \
+    WRITE_BATCH_SIZE, PLAYLIST_ITEM_FIELDS, API_RETRIES, API_RETRY_STATUSES, API_BACKOFF_FACTOR, \
+    HTTP_POOL_SIZE, PLAYLIST_ITEM_TYPES
 
 
 @dataclass
@@ -16,6 +28,39 @@ class SpotifyCredentials:
     client_secret: str
     redirect_uri: str
 
+
+def _orjson_response_hook(response: requests.Response, *args, **kwargs) -> requests.Response:
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+
+def _size_connection_pool(client: spotipy.Spotify) -> None:
+    """
+    Make the client's connection pool large enough for the concurrent lookups.
+    Clients without a requests session (requests_session=False) open a new connection per request anyway
+    """
+    if not isinstance(client._session, requests.Session):
+        return
+    for prefix in ('http://', 'https://'):
+        adapter = client._session.get_adapter(prefix)
+        if getattr(adapter, '_pool_maxsize', 0) >= HTTP_POOL_SIZE:
+            continue
+        # Keep the retry settings spotipy configured on its adapter
+        client._session.mount(prefix, requests.adapters.HTTPAdapter(max_retries=adapter.max_retries,
+                                                                    pool_maxsize=HTTP_POOL_SIZE))
+
+
+class OrjsonSpotify(spotipy.Spotify):
+    """
+    Spotify client that decodes API responses with orjson instead of the stdlib json module
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if isinstance(self._session, requests.Session):
+            self._session.hooks['response'].append(_orjson_response_hook)
+
+
 class PlaylistSplitter:
     """
     # PlaylistSplitter
@@ -23,10 +68,12 @@ class PlaylistSplitter:
     Splits playlists up by custom parameters, such as by artists or labels
     """
 
-    def __init__(self, login: Optional[spotipy.Spotify | dict[str, Any]] = None):
+    def __init__(self, login: Optional[spotipy.Spotify | dict[str, Any]] = None,
+                 cache_dir: Optional[str] = CACHE_DIR):
         """
 
         :param login: spotify client or dict with spotify credentials
+        :param cache_dir: directory to persist album labels in between runs. None to only cache in memory
         """
         self.client: Optional[spotipy.Spotify] = None
         self.credentials: Optional[SpotifyCredentials] = None
@@ -36,8 +83,15 @@ class PlaylistSplitter:
             self.credentials = SpotifyCredentials(**login)
         self.__origin_playlist: Optional[str] = None
         self.__target_playlists: Optional[list[str]] = None
-        self.__split_type: Optional[str] = None
-        self.__split_pools: Optional[list[set[str]]] = None
+        self.__split_type: Optional[SplitTypes] = None
+        self.__split_pools: Optional[tuple[frozenset[str], ...]] = None
+        self.__cache_file: Optional[str] = os.path.join(cache_dir, 'album_labels') if cache_dir else None
+        self.__album_label_cache: dict[str, str] = {}
+        self.__label_cache_loaded = False
+        self.__dispatch: dict[SplitTypes, Callable[[Iterable[dict[str, Any]]], list[list[str]]]] = {
+            SplitTypes.ARTIST: self.__split_by_artist,
+            SplitTypes.LABEL: self.__split_by_label,
+        }
 
     def __enter__(self):
         self.login()
@@ -46,6 +100,38 @@ class PlaylistSplitter:
     def __exit__(self, exc_type, exc_val, exc_tb):
         ...
 
+    def __open_label_cache(self, flag: str = 'c') -> shelve.Shelf:
+        os.makedirs(os.path.dirname(self.__cache_file), exist_ok=True)
+        return shelve.open(self.__cache_file, flag=flag)
+
+    def __load_label_cache(self):
+        """
+        Read the persisted album labels, only once and only when labels are needed
+        """
+        if self.__label_cache_loaded:
+            return
+        self.__label_cache_loaded = True
+        if self.__cache_file is None:
+            return
+        with self.__open_label_cache() as cache:
+            self.__album_label_cache.update(cache)
+
+    def __store_label_cache(self, album_labels: dict[str, str]):
+        self.__album_label_cache.update(album_labels)
+        if self.__cache_file is None or not album_labels:
+            return
+        with self.__open_label_cache() as cache:
+            cache.update(album_labels)
+
+    def clear_cache(self):
+        """
+        Remove all cached album labels, in memory and on disk
+        """
+        self.__album_label_cache.clear()
+        if self.__cache_file is not None:
+            with self.__open_label_cache(flag='n'):
+                pass
+
     def __get_credentials_from_env(self):
         client_id = os.getenv('SPOTIFY_CLIENT_ID')
         client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
@@ -58,13 +144,17 @@ class PlaylistSplitter:
             raise ValueError(
                 'Credentials not found, '
                 'make sure to pass them on instantiation or provide them in environment variables')
-        self.client = spotipy.Spotify(
+        self.client = OrjsonSpotify(
             auth_manager=SpotifyOAuth(
                 client_id=self.credentials.client_id,
                 client_secret=self.credentials.client_secret,
                 redirect_uri=self.credentials.redirect_uri,
                 scope=AUTHORIZATION_SCOPES
-            )
+            ),
+            retries=API_RETRIES,
+            status_retries=API_RETRIES,
+            status_forcelist=API_RETRY_STATUSES,
+            backoff_factor=API_BACKOFF_FACTOR
         )
 
     def login(self, credentials: Optional[dict[str, str]] = None):
@@ -74,10 +164,15 @@ class PlaylistSplitter:
             self.__get_credentials_from_env()
         self.__spotify_login()
 
-    def by(self, split_by: SplitTypes, split_lists: list[list[str]]):
-        print(f'Split by {split_by}')
+    def by(self, split_by: SplitTypes | str, split_lists: list[list[str]]):
+        try:
+            split_by = SplitTypes(split_by)
+        except ValueError:
+            raise ValueError(
+                f'Unknown split type {split_by!r}, must be one of {[t.value for t in SplitTypes]}') from None
+        print(f'Split by {split_by.value}')
         self.__split_type = split_by
-        self.__split_pools = split_lists
+        self.__split_pools = tuple(frozenset(pool) for pool in split_lists)
         return self
 
     def split_by(self, *args, **kwargs):
@@ -91,7 +186,7 @@ class PlaylistSplitter:
         self.__target_playlists = playlist_ids
         return self
 
-    def split(self, /, *, by: Optional[tuple[str, list[str]]] = None, playlist: Optional[str] = None,
+    def split(self, /, *, by: Optional[tuple[SplitTypes | str, list[str]]] = None, playlist: Optional[str] = None,
               into: Optional[list[str]] = None):
         """
         Split the playlist. Parameters can be passed here as keyword arguments if not set previously
@@ -99,8 +194,8 @@ class PlaylistSplitter:
         :param by: Tuple of what to split by (artist or label) and a list of groups.
                     Groups must contain ID, URI or URL (artist) or name (label).
         :param playlist: What playlist to split. Must be an ID, URI or URL
-        :param into: Target playlists to split into (must be same number as split pools).
-                      Must be list of IDs, URIs or URLs
+        :param into: Target playlists to split into (must be same number as split pools, or one more
+                      for the tracks not in any pool). Must be list of IDs, URIs or URLs
         """
         if by is not None:
             self.by(*by)
@@ -115,7 +210,8 @@ class PlaylistSplitter:
                 and len(self.__split_pools) + 1 != len(self.__target_playlists)):
             raise ValueError('List of target playlists must be same length as split pools (or unset)')
         if not self.__target_playlists:
-            self.__target_playlists = (self.__make_target_playlist() for _ in range(len(self.__split_pools)))
+            # One playlist per pool plus one for the tracks in none of them
+            self.__target_playlists = (self.__make_target_playlist() for _ in range(len(self.__split_pools) + 1))
         self.__do_split()
         print('Split done!')
 
@@ -124,59 +220,128 @@ class PlaylistSplitter:
         Internal method to do the actual splitting process
         :return:
         """
-        origin_tracks = [result['track'] for result in self.__get_all_playlist_items(self.__origin_playlist)]
+        # Also covers clients passed in on instantiation, not only those created by login()
+        _size_connection_pool(self.client)
+        # Tracks are split as their pages arrive rather than collected up front
+        origin_tracks = (result['track'] for result in self.__get_all_playlist_items(self.__origin_playlist))
 
-        # track_pools = self.__split_by_artist(origin_tracks)
         # Split depending on split type
-        track_pools = getattr(self, '_PlaylistSplitter__split_by_' + self.__split_type)(origin_tracks)
-        for tracks, playlist in zip(track_pools, self.__target_playlists, strict=True):
-            self.reset_playlist(playlist)
-            self.write_playlist(playlist, tracks)
+        track_pools = self.__dispatch[self.__split_type](origin_tracks)
+        # Target playlists are independent, so write them concurrently.
+        # Without a target for the last pool, tracks not in any pool are not written
+        with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor, \
+                tqdm(desc='Writing playlists', unit='chunk', total=0) as progress:
+            futures = [executor.submit(self.write_playlist, playlist, tracks, progress=progress)
+                       for tracks, playlist in zip(track_pools, self.__target_playlists)]
+            for future in as_completed(futures):
+                future.result()
 
-    def __split_by_artist(self, tracks: list[dict[str, Any]]) -> list[list[str]]:
+    def __pool_index(self) -> dict[str, int]:
+        """
+        Map each member of the split pools to the index of the first pool it appears in
+        """
+        index = {}
+        for idx, pool in enumerate(self.__split_pools):
+            for member in pool:
+                index.setdefault(member, idx)
+        return index
+
+    def __split_by_artist(self, tracks: Iterable[dict[str, Any]]) -> list[list[str]]:
         """
         Split tracks by artists
         :param tracks:
         :return:
         """
-        slimmed_tracks = [{'id': track['id'], 'artists': {artist['id'] for artist in track['artists']}} for track in
-                          tracks]
+        artist_to_pool = self.__pool_index()
         track_pools = [list() for _ in range(len(self.__split_pools) + 1)]
-        for track in tqdm(slimmed_tracks, desc='Splitting tracks'):
-            for idx, pool in enumerate(self.__split_pools):
-                if track['artists'].intersection(set(pool)):
-                    track_pools[idx].append(track['id'])
-                    break
-            else:
-                track_pools[-1].append(track['id'])
+        for track in tqdm(tracks, desc='Splitting tracks'):
+            # A track goes into the first pool containing any of its artists
+            idx = min((artist_to_pool[artist['id']] for artist in track['artists'] if artist['id'] in artist_to_pool),
+                      default=-1)
+            track_pools[idx].append(track['id'])
         return track_pools
 
-    def __split_by_label(self, tracks: list[dict[str, Any]]) -> list[list[str]]:
+    def __split_by_label(self, tracks: Iterable[dict[str, Any]]) -> list[list[str]]:
         """
         Split tracks by labels.
         :param tracks:
         :return:
         """
-        # Get details of each track from spotify API to extract the label
- #       slimmed_tracks = [{'id': track['id'], 'label': self.client.album(track['album']['id'])['label']} for track in tracks]
+        label_to_pool = self.__pool_index()
         track_pools = [list() for _ in range(len(self.__split_pools) + 1)]
-        for track in tqdm(self.__label_track_slimmer(tracks), desc='Splitting tracks', total=len(tracks)):
-            for idx, pool in enumerate(self.__split_pools):
-                if track['label'] in pool:
-                    track_pools[idx].append(track['id'])
-                    break
-            else:
-                track_pools[-1].append(track['id'])
+        for track in self.__label_track_slimmer(tracks):
+            track_pools[label_to_pool.get(track['label'], -1)].append(track['id'])
         return track_pools
 
-    def __label_track_slimmer(self, tracks: list[dict[str, Any]]):
+    def __label_track_slimmer(self, tracks: Iterable[dict[str, Any]]):
         """
         Yield details from each track from spotify API to extract the label
         :param tracks:
         :return:
         """
+        self.__load_label_cache()
+        with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor, \
+                tqdm(desc='Fetching labels', unit='album') as progress:
+            # The next batch is requested before the current one is yielded, so lookups don't wait on the split
+            pending = None
+            for batch, album_ids in self.__album_batches(tracks):
+                futures = [executor.submit(self.call_with_retry, self.client.albums, chunk)
+                           for chunk in self.chunk_list(album_ids, ALBUM_BATCH_SIZE)]
+                if pending is not None:
+                    yield from self.__label_batch(*pending, progress)
+                pending = batch, futures
+            if pending is not None:
+                yield from self.__label_batch(*pending, progress)
+
+    def __album_batches(self, tracks: Iterable[dict[str, Any]]):
+        """
+        Group tracks into batches that together need enough new albums to give every worker a full request
+        :param tracks:
+        :return: tuples of the tracks and the album IDs to look up for them
+        """
+        requested = set()
+        batch, album_ids = [], []
         for track in tracks:
-            yield {'id': track['id'], 'label': self.client.album(track['album']['id'])['label']}
+            batch.append(track)
+            album_id = track['album']['id']
+            if album_id in requested or album_id in self.__album_label_cache:
+                continue
+            requested.add(album_id)
+            album_ids.append(album_id)
+            if len(album_ids) == ALBUM_BATCH_SIZE * LOOKUP_WORKERS:
+                yield batch, album_ids
+                batch, album_ids = [], []
+        if batch:
+            yield batch, album_ids
+
+    def __label_batch(self, batch: list[dict[str, Any]], futures: list[Future], progress: tqdm):
+        """
+        Wait for the album lookups of a batch and yield its tracks with their labels
+        """
+        album_labels = {}
+        for future in as_completed(futures):
+            albums = future.result()['albums']
+            album_labels.update({album['id']: album['label'] for album in albums})
+            progress.update(len(albums))
+        self.__store_label_cache(album_labels)
+        for track in batch:
+            yield {'id': track['id'], 'label': self.__album_label_cache[track['album']['id']]}
+
+    @staticmethod
+    def call_with_retry(func: Callable, *args, **kwargs) -> Any:
+        """
+        Call a Spotify API method, waiting for the time given in the Retry-After header when rate limited.
+        Errors without that header are raised right away, including the 429 spotipy reports once the
+        session retries are exhausted, whatever the actual status was
+        """
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                retry_after = (e.headers or {}).get('Retry-After')
+                if e.http_status != 429 or retry_after is None or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                time.sleep(int(retry_after))
 
     def __make_target_playlist(self) -> str:
         """
@@ -184,39 +349,72 @@ class PlaylistSplitter:
 
         :return: List of playlist IDs
         """
-        return self.client.user_playlist_create(self.client.current_user()['id'], 'test1')
+        return self.client.current_user_playlist_create('test1')['id']
+
+    def __get_all_playlist_items(self, playlist_id) -> Generator[dict[str, Any], None, None]:
+        results = self.call_with_retry(self.client.playlist_items, playlist_id, fields=PLAYLIST_ITEM_FIELDS,
+                                       limit=PAGE_SIZE, additional_types=PLAYLIST_ITEM_TYPES)
+        yield from results['items']
+        # All remaining pages are known from the total, so fetch them in parallel.
+        # Only a limited number of pages is in flight at once to keep memory bounded
+        pages = math.ceil(results['total'] / PAGE_SIZE)
+        with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+            pending = deque()
+            for page in range(1, pages):
+                pending.append(executor.submit(self.call_with_retry, self.client.playlist_items, playlist_id,
+                                               fields=PLAYLIST_ITEM_FIELDS, offset=page * PAGE_SIZE, limit=PAGE_SIZE,
+                                               additional_types=PLAYLIST_ITEM_TYPES))
+                if len(pending) == LOOKUP_WORKERS:
+                    yield from pending.popleft().result()['items']
+            while pending:
+                yield from pending.popleft().result()['items']
 
-    def __get_all_playlist_items(self, playlist_id):
-        playlist_tracks = []
-        results = self.client.playlist(playlist_id)
-        playlist_tracks.extend(results['tracks']['items'])
-        while results['tracks']['next']:
-            results['tracks'] = self.client.next(results['tracks'])
-            playlist_tracks.extend(results['tracks']['items'])
-        return playlist_tracks
+    @staticmethod
+    def chunk_list(items: Iterable[Any], size: int) -> Generator[list[Any], None, None]:
+        """
+        Split an iterable into lists of at most `size` elements
+        """
+        iterator = iter(items)
+        while chunk := list(islice(iterator, size)):
+            yield chunk
 
     @staticmethod
     def chunk_track_list(tracks: list[str]) -> Generator[list[dict[str, Any]], None, None]:
         """
         Split the playlist into chunks to avoid the Spotify API limit
         """
-        for i in range(0, len(tracks), 50):
-            yield tracks[i: i + 50]
+        yield from PlaylistSplitter.chunk_list(tracks, WRITE_BATCH_SIZE)
 
-    def write_playlist(self, playlist: str, track_list: list[str]) -> None:
+    def write_playlist(self, playlist: str, track_list: list[str], dedupe: bool = True,
+                       progress: Optional[tqdm] = None) -> None:
         """
         Write the playlist to the Spotify API
+
+        :param dedupe: only write the first occurrence of each track
+        :param progress: shared progress bar to count written chunks on, instead of showing one for this playlist
         """
+        if dedupe:
+            unique_tracks = list(dict.fromkeys(track_list))
+            if removed := len(track_list) - len(unique_tracks):
+                tqdm.write(f'Removed {removed} duplicate tracks from {playlist}')
+            track_list = unique_tracks
         self.reset_playlist(playlist)
         chunked_list = list(self.chunk_track_list(track_list))
-        for chunk in tqdm(chunked_list, desc='Writing playlist'):
-            self.client.playlist_add_items(playlist, chunk)
+        if progress is None:
+            for chunk in tqdm(chunked_list, desc='Writing playlist'):
+                self.call_with_retry(self.client.playlist_add_items, playlist, chunk)
+            return
+        with progress.get_lock():
+            progress.total += len(chunked_list)
+            progress.refresh()
+        for chunk in chunked_list:
+            # Chunks are appended in order, so they can't be sent concurrently to the same playlist
+            self.call_with_retry(self.client.playlist_add_items, playlist, chunk)
+            with progress.get_lock():
+                progress.update()
 
     def reset_playlist(self, playlist_id: str) -> None:
         """
         Remove all elements in the playlist
         """
-        self.client.playlist_replace_items(playlist_id, ['spotify:track:4RWkW7tGWseUu1T9LzpEBP'])
-        self.client.playlist_remove_all_occurrences_of_items(
-            playlist_id, ['spotify:track:4RWkW7tGWseUu1T9LzpEBP']
-        )
+        self.client.playlist_replace_items(playlist_id, [])
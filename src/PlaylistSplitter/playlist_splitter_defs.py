@@ -1,3 +1,4 @@
+import os
 from enum import Enum
 
 AUTHORIZATION_SCOPES = 'playlist-modify-private playlist-read-private playlist-modify-public'
@@ -6,3 +7,28 @@ AUTHORIZATION_SCOPES = 'playlist-modify-private playlist-read-private playlist-m
 class SplitTypes(Enum):
     ARTIST = 'artist'
     LABEL = 'label'
+
+
+# Number of concurrent requests when fetching from the Spotify API
+LOOKUP_WORKERS = 16
+# Connections kept per host, enough for the page and album lookups running at the same time
+HTTP_POOL_SIZE = 2 * LOOKUP_WORKERS
+# How often a rate limited (HTTP 429) request is retried before giving up
+RATE_LIMIT_RETRIES = 5
+# Retry settings for the HTTP session of the Spotify client
+API_RETRIES = 10
+API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+API_BACKOFF_FACTOR = 0.3
+# Maximum number of playlist items the Spotify API returns per request
+PAGE_SIZE = 100
+# Only request tracks, like client.playlist does, so episodes aren't returned as episode objects
+PLAYLIST_ITEM_TYPES = ('track',)
+# Only fetch the parts of playlist items that are needed for splitting
+PLAYLIST_ITEM_FIELDS = 'items(track(id,album(id),artists(id))),total'
+# Maximum number of tracks that can be added to a playlist per request
+WRITE_BATCH_SIZE = 100
+# Maximum number of albums the Spotify API returns per request
+ALBUM_BATCH_SIZE = 20
+# Where album labels are persisted between runs
+CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                         'PlaylistSplitter')